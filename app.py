@@ -1,12 +1,20 @@
 from flask import Flask, render_template, request, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
 import re
 import json
 import os
 import tempfile
 import logging
+import hashlib
+import atexit
 from chatbot import diamond_chatbot, create_solr_client, extract_constraints_from_query
 from groq import Groq
 from dotenv import load_dotenv
+from cache import shared_cache, STT_CACHE_TTL
+from media import media_bp
+from warming import popular_queries, start_cache_warming
+from capture import start_trace, stage, annotate, finish_trace
+from groq_scheduler import groq_scheduler, set_session, estimate_tokens, AdmissionRejected, EXPERT_ANALYSIS, TRANSCRIPTION
 
 def convert_markdown_to_html(text):
     """
@@ -19,10 +27,24 @@ app = Flask(__name__)
 # Load environment variables
 load_dotenv()
 
+# Local catalog media (images, videos, PDFs); set USE_X_SENDFILE=1 when behind a sendfile-capable proxy
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "0") == "1"
+app.register_blueprint(media_bp)
+
+# Only trust X-Forwarded-For when running behind this many known reverse proxies
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "0"))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
 # Initialize Groq client and Solr client
 client = Groq()
 solr_client = create_solr_client()
 
+# Warm the shared cache with the most popular searches after a restart
+if os.getenv("WARM_ON_START", "1") == "1":
+    start_cache_warming(solr_client, client)
+atexit.register(popular_queries.flush)
+
 def generate_expert_analysis(user_query, diamond_data):
     """
     Generate expert analysis using Groq.
@@ -50,12 +72,17 @@ def generate_expert_analysis(user_query, diamond_data):
     """
     
     try:
+        # Expert analysis yields to chat narratives; a rejection falls through to the default text
+        estimated_tokens = estimate_tokens(prompt, 250)
+        groq_scheduler.acquire("llama-3.3-70b-specdec", estimated_tokens, kind=EXPERT_ANALYSIS)
         chat_completion = client.chat.completions.create(
             messages=[{"role": "system", "content": prompt}],
             model="llama-3.3-70b-specdec",
             temperature=0.7,
             max_tokens=250
         )
+        usage = getattr(chat_completion, "usage", None)
+        groq_scheduler.reconcile("llama-3.3-70b-specdec", estimated_tokens, getattr(usage, "total_tokens", None))
         analysis = chat_completion.choices[0].message.content
         
         # Wrap the analysis in our special tags for styling
@@ -64,106 +91,198 @@ def generate_expert_analysis(user_query, diamond_data):
         print(f"Error generating expert analysis: {e}")
         return "<expert-analysis>These diamonds match your criteria and offer excellent value. Consider factors like Cut quality and Color which significantly impact a diamond's brilliance.</expert-analysis>"
 
+def client_session_id():
+    """
+    Identify the caller for fair sharing of Groq capacity by remote address
+    (the real client address when TRUSTED_PROXY_COUNT is set).
+    """
+    return request.remote_addr
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        data = request.get_json()
-        user_query = data.get('message', '').strip()
-
-        if not user_query:
-            return jsonify({
-                'response': "I'm your diamond assistant. How can I help you find the perfect diamond today?"
-            })
+def answer_query(user_query):
+    """
+    Run the chat pipeline for one query and return the JSON payload used by /chat.
+    """
+    if not user_query:
+        return {
+            'response': "I'm your diamond assistant. How can I help you find the perfect diamond today?"
+        }
 
+    start_trace(user_query)
+    with stage("extract"):
         constraints = extract_constraints_from_query(user_query)
-        ordering_keywords = ["maximum", "minimum", "lowest", "highest", "largest", "smallest", "cheapest", "lowest price", "affordable", "low budget", "most expensive", "highest price", "priciest", "expensive", "high budget"]
-        if ("Style" not in constraints and 
-            user_query.lower() not in ["hi", "hello"] and 
-            (len(constraints) > 0 or any(keyword in user_query.lower() for keyword in ordering_keywords))):
-            return jsonify({
-                'response': "Would you prefer a lab-grown or natural diamond? Lab-grown diamonds are eco-friendly and more affordable, while natural diamonds are mined from the earth and traditionally valued.",
-                'needs_style': True
-            })
+    annotate("constraints", constraints)
+    ordering_keywords = ["maximum", "minimum", "lowest", "highest", "largest", "smallest", "cheapest", "lowest price", "affordable", "low budget", "most expensive", "highest price", "priciest", "expensive", "high budget"]
+    if ("Style" not in constraints and 
+        user_query.lower() not in ["hi", "hello"] and 
+        (len(constraints) > 0 or any(keyword in user_query.lower() for keyword in ordering_keywords))):
+        return {
+            'response': "Would you prefer a lab-grown or natural diamond? Lab-grown diamonds are eco-friendly and more affordable, while natural diamonds are mined from the earth and traditionally valued.",
+            'needs_style': True
+        }
 
+    popular_queries.record(user_query, constraints)
+    with stage("chatbot"):
         response = diamond_chatbot(user_query, solr_client, client)
-        if not response:
-            response = "I'm having trouble understanding your request. Could you please provide more details about the diamond you're looking for?"
-
-        # Extract the diamond-data block from the Groq response
-        diamond_data_match = re.search(r'<diamond-data>([\s\S]*?)</diamond-data>', response)
-        diamond_data = None
-        if diamond_data_match:
-            try:
-                diamond_data = json.loads(diamond_data_match.group(1))
-            except json.JSONDecodeError:
-                print("Error decoding diamond data JSON")
-
-        # Generate expert analysis ONLY if we have valid diamond data
-        expert_recommendation_html = None
-        if diamond_data:
-            expert_recommendation = generate_expert_analysis(user_query, diamond_data)
-            expert_recommendation_html = convert_markdown_to_html(expert_recommendation)
+    if not response:
+        response = "I'm having trouble understanding your request. Could you please provide more details about the diamond you're looking for?"
 
-        # IMPORTANT: Do not append the expert analysis to the response text!
-        # Instead, return it separately.
-        response_html = convert_markdown_to_html(response)
+    # Extract the diamond-data block from the Groq response
+    diamond_data_match = re.search(r'<diamond-data>([\s\S]*?)</diamond-data>', response)
+    diamond_data = None
+    if diamond_data_match:
+        try:
+            diamond_data = json.loads(diamond_data_match.group(1))
+        except json.JSONDecodeError:
+            print("Error decoding diamond data JSON")
 
-        return jsonify({
-            'response': response_html,
-            'expert_recommendation': expert_recommendation_html
-        })
+    # Generate expert analysis ONLY if we have valid diamond data
+    expert_recommendation_html = None
+    if diamond_data:
+        with stage("expert"):
+            expert_recommendation = generate_expert_analysis(user_query, diamond_data)
+        expert_recommendation_html = convert_markdown_to_html(expert_recommendation)
 
-    except Exception as e:
-        print(f"Error in chat endpoint: {e}")
-        return jsonify({
-            'response': "I apologize, but I encountered an error. Please try your request again."
-        }), 500
+    # IMPORTANT: Do not append the expert analysis to the response text!
+    # Instead, return it separately.
+    response_html = convert_markdown_to_html(response)
 
-@app.route('/speech-to-text', methods=['POST'])
-def speech_to_text():
-    try:
-        if 'audio' not in request.files:
-            logging.error("No audio file provided in request.")
-            return jsonify({"error": "No audio file provided"}), 400
+    return {
+        'response': response_html,
+        'expert_recommendation': expert_recommendation_html
+    }
 
-        audio_file = request.files['audio']
+def transcribe_audio(audio_bytes):
+    """
+    Transcribe an uploaded recording with Groq Whisper, using the shared transcript cache.
+    Returns an empty string if Groq returned no text.
+    """
+    # Identical recordings (e.g. client retries) reuse the shared transcript cache
+    cache_key = hashlib.sha256(audio_bytes).hexdigest()
+    cached_transcript = shared_cache.get("stt", cache_key)
+    if cached_transcript:
+        return cached_transcript
 
-        # Save the uploaded audio file to a secure temporary location
-        with tempfile.NamedTemporaryFile(suffix=".m4a", delete=False) as tmp:
-            audio_file.save(tmp.name)
-            tmp_path = tmp.name
+    # Save the uploaded audio file to a secure temporary location
+    with tempfile.NamedTemporaryFile(suffix=".m4a", delete=False) as tmp:
+        tmp.write(audio_bytes)
+        tmp_path = tmp.name
 
+    try:
         # Use the Groq API to transcribe the audio with the finalized whisper-large-v3-turbo model
         with open(tmp_path, "rb") as file:
+            groq_scheduler.acquire("whisper-large-v3-turbo", kind=TRANSCRIPTION)
             transcription_response = client.audio.transcriptions.create(
                 file=(tmp_path, file.read()),
                 model="whisper-large-v3-turbo",
                 response_format="verbose_json",
             )
-    
-        transcript = transcription_response.text.strip()
-
+    finally:
         # Remove the temporary file immediately after transcription
         try:
             os.remove(tmp_path)
         except Exception as remove_error:
             logging.warning(f"Failed to remove temporary file {tmp_path}: {remove_error}")
 
-        # Log and return the transcript if available
+    transcript = transcription_response.text.strip()
+    if transcript:
+        logging.info("Audio transcription successful.")
+        shared_cache.set("stt", cache_key, transcript, STT_CACHE_TTL)
+    return transcript
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    try:
+        set_session(client_session_id())
+        data = request.get_json()
+        user_query = data.get('message', '').strip()
+        return jsonify(answer_query(user_query))
+
+    except AdmissionRejected as e:
+        print(f"Groq admission rejected: {e}")
+        return jsonify({
+            'response': "We're helping a lot of customers right now. Please try again in a few seconds."
+        }), 503, {'Retry-After': str(int(e.retry_after) + 1)}
+
+    except Exception as e:
+        print(f"Error in chat endpoint: {e}")
+        return jsonify({
+            'response': "I apologize, but I encountered an error. Please try your request again."
+        }), 500
+    finally:
+        finish_trace()
+
+@app.route('/speech-to-text', methods=['POST'])
+def speech_to_text():
+    try:
+        set_session(client_session_id())
+        if 'audio' not in request.files:
+            logging.error("No audio file provided in request.")
+            return jsonify({"error": "No audio file provided"}), 400
+
+        transcript = transcribe_audio(request.files['audio'].read())
+
+        # Return the transcript if available
         if transcript:
-            logging.info("Audio transcription successful.")
             return jsonify({"transcript": transcript})
         else:
             logging.error("Transcription returned empty result.")
             return jsonify({"error": "Transcription failed, no transcript returned."}), 500
 
+    except AdmissionRejected as e:
+        logging.warning(f"Transcription rejected by Groq scheduler: {e}")
+        return jsonify({"error": "Voice service is busy, please try again."}), 503, {'Retry-After': str(int(e.retry_after) + 1)}
+
     except Exception as e:
         logging.exception("Error during speech-to-text processing:")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/voice-chat', methods=['POST'])
+def voice_chat():
+    """
+    Transcribe a voice query and answer it in the same request, saving the client a second
+    round trip to /chat. An optional 'style' form field (labgrown/natural) is appended to the
+    transcript, the same way the style popup completes a pending /chat query.
+    """
+    transcript = None
+    try:
+        set_session(client_session_id())
+        if 'audio' not in request.files:
+            logging.error("No audio file provided in request.")
+            return jsonify({"error": "No audio file provided"}), 400
+
+        transcript = transcribe_audio(request.files['audio'].read())
+        if not transcript:
+            logging.error("Transcription returned empty result.")
+            return jsonify({"error": "Transcription failed, no transcript returned."}), 500
+
+        user_query = transcript
+        style = request.form.get('style', '').strip()
+        if style:
+            user_query = f"{transcript} {style}"
+
+        result = answer_query(user_query)
+        result['transcript'] = transcript
+        return jsonify(result)
+
+    except AdmissionRejected as e:
+        logging.warning(f"Voice chat rejected by Groq scheduler: {e}")
+        return jsonify({
+            'transcript': transcript,
+            'error': "We're helping a lot of customers right now. Please try again in a few seconds."
+        }), 503, {'Retry-After': str(int(e.retry_after) + 1)}
+
+    except Exception as e:
+        logging.exception("Error during voice chat processing:")
+        return jsonify({
+            'transcript': transcript,
+            'error': "I apologize, but I encountered an error. Please try your request again."
+        }), 500
+    finally:
+        finish_trace()
+
 if __name__ == '__main__':
     app.run(debug=False, host='0.0.0.0', port=5505)
@@ -0,0 +1,203 @@
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+import hashlib
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") != "0"
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(tempfile.gettempdir(), "gemma_cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+
+# Default TTLs (seconds) for the caches sitting in front of Solr, Groq chat and Groq transcription
+SOLR_CACHE_TTL = int(os.getenv("SOLR_CACHE_TTL", "300"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+STT_CACHE_TTL = int(os.getenv("STT_CACHE_TTL", "86400"))
+
+# Payloads larger than this are zlib-compressed before being written
+COMPRESS_THRESHOLD = 512
+# Only refresh an entry's access time if it is older than this (keeps reads mostly read-only)
+TOUCH_INTERVAL = 60
+# How many writes between eviction checks, and what fraction of entries to evict when over capacity
+EVICT_CHECK_EVERY = 200
+EVICT_FRACTION = 0.1
+
+
+# ------------------- Key Helpers -------------------
+def make_cache_key(*parts):
+    """
+    Build a stable key from any JSON-serializable parts (query params, prompts, etc.).
+    """
+    raw = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+# ------------------- Serialization -------------------
+def _dumps(value):
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    if len(data) > COMPRESS_THRESHOLD:
+        return zlib.compress(data, 6), 1
+    return data, 0
+
+
+def _loads(data, compressed):
+    if compressed:
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+# ------------------- Shared SQLite Cache -------------------
+class SharedCache:
+    """
+    Host-wide cache shared by every worker process, backed by a WAL-mode SQLite file.
+    Entries carry a TTL and are evicted in approximate LRU order once the table grows
+    past max_entries. Connections are opened lazily per process and thread, so the
+    cache is safe to use from forked Flask/gunicorn workers.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, enabled=CACHE_ENABLED):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._local = threading.local()
+        self._writes = 0
+
+    def connection(self):
+        """
+        Return this process/thread's SQLite connection, opening it on first use.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        # New process (after fork) or new thread: never reuse an inherited connection
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value BLOB NOT NULL,"
+            " compressed INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace, key, default=None):
+        if not self.enabled:
+            return default
+        try:
+            conn = self.connection()
+            row = conn.execute(
+                "SELECT value, compressed, expires_at, accessed_at FROM cache WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+            if row is None:
+                return default
+            value, compressed, expires_at, accessed_at = row
+            now = time.time()
+            if expires_at < now:
+                conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                return default
+            if now - accessed_at > TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    (now, namespace, key)
+                )
+            return _loads(value, compressed)
+        except Exception as e:
+            print(f"Cache get error: {e}")
+            return default
+
+    def set(self, namespace, key, value, ttl):
+        if not self.enabled:
+            return
+        try:
+            data, compressed = _dumps(value)
+            now = time.time()
+            conn = self.connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, compressed, expires_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, sqlite3.Binary(data), compressed, now + ttl, now)
+            )
+            self._writes += 1
+            if self._writes % EVICT_CHECK_EVERY == 0:
+                self.evict()
+        except Exception as e:
+            print(f"Cache set error: {e}")
+
+    def add(self, namespace, key, value, ttl):
+        """
+        Store value only if the key is absent or expired, atomically across processes.
+        Returns True if this caller stored it (usable as a host-wide lock).
+        """
+        if not self.enabled:
+            return True
+        try:
+            data, compressed = _dumps(value)
+            now = time.time()
+            conn = self.connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key = ? AND expires_at < ?",
+                    (namespace, key, now)
+                )
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO cache (namespace, key, value, compressed, expires_at, accessed_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (namespace, key, sqlite3.Binary(data), compressed, now + ttl, now)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return cursor.rowcount == 1
+        except Exception as e:
+            print(f"Cache add error: {e}")
+            return False
+
+    def evict(self):
+        """
+        Drop expired entries, then the least recently used ones if still over capacity.
+        """
+        conn = self.connection()
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            excess = count - self.max_entries + int(self.max_entries * EVICT_FRACTION)
+            conn.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                (excess,)
+            )
+
+    def clear(self, namespace=None):
+        """
+        Invalidate one namespace (e.g. "solr" after a reindex) or the whole cache.
+        """
+        if not self.enabled:
+            return
+        try:
+            conn = self.connection()
+            if namespace is None:
+                conn.execute("DELETE FROM cache")
+            else:
+                conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+        except Exception as e:
+            print(f"Cache clear error: {e}")
+
+
+shared_cache = SharedCache()
@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import glob
+import time
+import queue
+import threading
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# Capture is opt-in: set CAPTURE_DIR to start writing capture-<pid>.jsonl files there
+CAPTURE_DIR = os.getenv("CAPTURE_DIR")
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))
+CAPTURE_BACKUPS = int(os.getenv("CAPTURE_BACKUPS", "5"))
+# File names include the pid, so restarted workers leave files behind; cap their total size
+CAPTURE_MAX_TOTAL_BYTES = int(os.getenv("CAPTURE_MAX_TOTAL_BYTES", str(1024 * 1024 * 1024)))
+CAPTURE_QUEUE_SIZE = 10000
+
+_current_trace = contextvars.ContextVar("capture_trace", default=None)
+_capture_logger = None
+_capture_logger_lock = threading.Lock()
+
+
+# ------------------- Anonymization -------------------
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+# Candidate digit runs with separators, e.g. phone numbers or report/order ids
+NUMBER_RUN_PATTERN = re.compile(r'\+?\(?\d[\d\s().-]*\d')
+
+
+def _scrub_number(match):
+    # Keep prices (even "1000000") and ranges such as "3000-10000" or "5000 - 8000" (two groups).
+    # Scrub unbroken runs of 9+ digits (phone/report numbers) and grouped numbers with 7+
+    # digits in three or more groups, like "555-123-4567".
+    groups = re.findall(r'\d+', match.group(0))
+    digits = sum(len(group) for group in groups)
+    if (len(groups) == 1 and digits >= 9) or (len(groups) >= 3 and digits >= 7):
+        return "<number>"
+    return match.group(0)
+
+
+def anonymize_query(text):
+    """
+    Strip emails and long digit runs (phone numbers, report numbers) from a user query.
+    Carat and price values, including ranges, survive so replays parse the same constraints.
+    """
+    text = EMAIL_PATTERN.sub("<email>", text)
+    return NUMBER_RUN_PATTERN.sub(_scrub_number, text)
+
+
+# ------------------- Writer -------------------
+def prune_captures(keep=None):
+    """
+    Delete the oldest capture files in CAPTURE_DIR until all of them together fit in
+    CAPTURE_MAX_TOTAL_BYTES. The file named by keep (the caller's active file) is never removed.
+    """
+    files = []
+    for path in glob.glob(os.path.join(CAPTURE_DIR, "capture-*.jsonl*")):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # Removed by another worker's prune
+        files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= CAPTURE_MAX_TOTAL_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError as e:
+            print(f"Capture prune error for {path}: {e}")
+
+
+class _PruningFileHandler(logging.handlers.RotatingFileHandler):
+    def doRollover(self):
+        super().doRollover()
+        # Runs on the listener thread, never on a request thread
+        prune_captures(keep=self.baseFilename)
+
+
+def _get_logger():
+    """
+    Lazily create a per-process rotating JSONL writer fed from a queue, so request
+    threads never block on disk I/O.
+    """
+    global _capture_logger
+    if _capture_logger is not None:
+        return _capture_logger
+    with _capture_logger_lock:
+        if _capture_logger is not None:
+            return _capture_logger
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        prune_captures()
+        file_handler = _PruningFileHandler(
+            os.path.join(CAPTURE_DIR, f"capture-{os.getpid()}.jsonl"),
+            maxBytes=CAPTURE_MAX_BYTES, backupCount=CAPTURE_BACKUPS, encoding="utf-8"
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        record_queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        logging.handlers.QueueListener(record_queue, file_handler).start()
+
+        logger = logging.getLogger(f"capture.{os.getpid()}")
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        logger.addHandler(_DroppingQueueHandler(record_queue))
+        _capture_logger = logger
+    return _capture_logger
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        # Drop records rather than slow requests down when the writer falls behind
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+# ------------------- Request Traces -------------------
+def start_trace(user_query):
+    """
+    Begin capturing the current request. No-op unless CAPTURE_DIR is set.
+    """
+    if not CAPTURE_DIR:
+        return
+    _current_trace.set({"ts": time.time(), "query": anonymize_query(user_query), "timings": {}})
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a pipeline stage (in ms) into the current trace, if one is active.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace["timings"][name] = round((time.perf_counter() - started) * 1000, 3)
+
+
+def annotate(key, value):
+    """
+    Attach a value (constraints, Solr params, cache hits) to the current trace.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace[key] = value
+
+
+def finish_trace(**fields):
+    """
+    Write the current trace as one JSONL record and end it.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    _current_trace.set(None)
+    trace["timings"]["total"] = round((time.time() - trace["ts"]) * 1000, 3)
+    trace.update(fields)
+    try:
+        _get_logger().info(json.dumps(trace, separators=(",", ":"), default=str))
+    except Exception as e:
+        print(f"Capture write error: {e}")
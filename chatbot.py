@@ -1,10 +1,13 @@
 import re
 import json
 import os
-import random
+import numpy as np
 from dotenv import load_dotenv
 import pysolr
 from groq import Groq
+from cache import shared_cache, make_cache_key, SOLR_CACHE_TTL, LLM_CACHE_TTL
+from capture import stage, annotate
+from groq_scheduler import groq_scheduler, estimate_tokens, NARRATIVE
 
 # Load environment variables
 load_dotenv()
@@ -46,6 +49,11 @@ COMMON_MISSPELLINGS = {
     "usd": "$", "dollars": "$", "dollar": "$", "price": "budget", "cost": "budget",
     "thousand": "1000", "thousands": "1000", "grand": "1000"
 }
+# ------------------- Grade Orderings (best first) -------------------
+COLOR_ORDERING = ["D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N"]
+CLARITY_ORDERING = ["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2"]
+QUALITY_ORDERING = ["ID", "EX", "VG", "GD", "F", "P"]
+
 # ------------------- Price Conversion Utility -------------------
 def convert_price_str(price_str):
     """ Converts '10k' -> 10000, '2.5k' -> 2500, and removes commas """
@@ -244,16 +252,15 @@ def extract_constraints_from_query(user_query):
     # ----- Color Range -----
     color_range_match = re.search(r'\bcolors?\s+(?:between|from|range)?\s+([defghijklmn])\s+(?:to|and|through|[-])\s+([defghijklmn])', query_lower)
     if color_range_match:
-        color_ordering = ["D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N"]
         start = color_range_match.group(1).upper()
         end = color_range_match.group(2).upper()
-        start_idx = color_ordering.index(start)
-        end_idx = color_ordering.index(end)
+        start_idx = COLOR_ORDERING.index(start)
+        end_idx = COLOR_ORDERING.index(end)
         # Ensure proper order - D is better than N
         if start_idx <= end_idx:
-            constraints["ColorRange"] = color_ordering[start_idx:end_idx+1]
+            constraints["ColorRange"] = COLOR_ORDERING[start_idx:end_idx+1]
         else:
-            constraints["ColorRange"] = color_ordering[end_idx:start_idx+1]
+            constraints["ColorRange"] = COLOR_ORDERING[end_idx:start_idx+1]
 
     # ----- Clarity -----
     clarity_match = re.search(r'\b(if|vvs1|vvs2|vs1|vs2|si1|si2)\b', user_query, re.IGNORECASE)
@@ -263,16 +270,15 @@ def extract_constraints_from_query(user_query):
     # ----- Clarity Range -----
     clarity_range_match = re.search(r'\bclarity\s+(?:between|from|range)?\s+(if|vvs1|vvs2|vs1|vs2|si1|si2)\s+(?:to|and|through|[-])\s+(if|vvs1|vvs2|vs1|vs2|si1|si2)', query_lower)
     if clarity_range_match:
-        clarity_ordering = ["IF", "VVS1", "VVS2", "VS1", "VS2", "SI1", "SI2"]
         start = clarity_range_match.group(1).upper()
         end = clarity_range_match.group(2).upper()
-        start_idx = clarity_ordering.index(start)
-        end_idx = clarity_ordering.index(end)
+        start_idx = CLARITY_ORDERING.index(start)
+        end_idx = CLARITY_ORDERING.index(end)
         # Ensure proper order - IF is better than SI2
         if start_idx <= end_idx:
-            constraints["ClarityRange"] = clarity_ordering[start_idx:end_idx+1]
+            constraints["ClarityRange"] = CLARITY_ORDERING[start_idx:end_idx+1]
         else:
-            constraints["ClarityRange"] = clarity_ordering[end_idx:start_idx+1]
+            constraints["ClarityRange"] = CLARITY_ORDERING[end_idx:start_idx+1]
     
     # ----- Cut, Polish, Symmetry Quality -----
     quality_mapping = {
@@ -286,7 +292,7 @@ def extract_constraints_from_query(user_query):
         "gd": "GD",
         "f": "F",
         "p": "P",
-        "fr": "FR"
+        "fr": "F"
     }
     quality_pattern_cut_polish = r'(?:\b{attr}\b\s*(?:is\s*)?((?:ex|excellent|id|ideal|vg|very good|good|gd|f|p)))|(?:(?:(ex|excellent|id|ideal|vg|very good|good|gd|f|p))\s+\b{attr}\b)'
 
@@ -590,15 +596,131 @@ def direct_solr_search(user_query, solr_client, top_k=10):
     if sort_fields:
         query_params["sort"] = ", ".join(sort_fields)
 
+    annotate("solr_params", query_params)
+
+    # Shared cache across all workers, keyed on the final Solr parameters
+    cache_key = make_cache_key(query_params)
+    cached_docs = shared_cache.get("solr", cache_key)
+    if cached_docs is not None:
+        annotate("solr_cache_hit", True)
+        return cached_docs
+
     try:
-        results = solr_client.search(**query_params)
+        with stage("solr"):
+            results = solr_client.search(**query_params)
         if not results.docs:
             print("No documents found in Solr results.")
+        shared_cache.set("solr", cache_key, results.docs, SOLR_CACHE_TTL)
         return results.docs
     except Exception as e:
         print(f"Solr search error: {e}")
         return []
 
+# ------------------- Candidate Reranking -------------------
+def _grade_indices(docs, field, ordering):
+    """ Ordinal index of each doc's grade (0 = best), NaN if missing or unknown """
+    lookup = {grade: i for i, grade in enumerate(ordering)}
+    return np.array([lookup.get(str(doc.get(field) or "").upper(), np.nan) for doc in docs], dtype=float)
+
+def _grade_distance(indices, ordering, constraints, key, range_key):
+    """ Normalized distance from the requested grade or grade range (0 = exact match) """
+    size = len(ordering) - 1
+    if key in constraints and constraints[key].upper() in ordering:
+        target = ordering.index(constraints[key].upper())
+        return np.abs(indices - target) / size
+    if range_key in constraints:
+        low = ordering.index(constraints[range_key][0])
+        high = ordering.index(constraints[range_key][-1])
+        return (np.clip(low - indices, 0, None) + np.clip(indices - high, 0, None)) / size
+    # No preference: mildly favour better grades
+    return 0.25 * indices / size
+
+def _target_price(constraints):
+    for key in ["BudgetTarget", "BudgetMax", "Budget", "BudgetMin"]:
+        if key in constraints:
+            return constraints[key]
+    if "BudgetLow" in constraints and "BudgetHigh" in constraints:
+        return (constraints["BudgetLow"] + constraints["BudgetHigh"]) / 2
+    return None
+
+def _target_carat(constraints):
+    if "Carat" in constraints:
+        return constraints["Carat"]
+    if "CaratLow" in constraints and "CaratHigh" in constraints:
+        return (constraints["CaratLow"] + constraints["CaratHigh"]) / 2
+    return constraints.get("CaratLow") or constraints.get("CaratHigh")
+
+def rerank_candidates(docs, constraints, user_query="", k=5, diversity=0.3):
+    """
+    Score all Solr candidates at once and pick k with an MMR-style diversity pass.
+    Relevance combines distance to the requested carat and budget, ordinal color/clarity
+    distance, and cut/polish/symmetry quality, with the Solr order as a tie-breaker.
+    Explicit ordering requests (cheapest/most expensive, largest carat) are followed exactly,
+    with relevance only breaking ties and no diversity pass.
+    """
+    if len(docs) <= 1:
+        return docs[:k]
+    n = len(docs)
+    carat = np.array([doc.get("Carat") or np.nan for doc in docs], dtype=float)
+    price = np.array([doc.get("Price") or np.nan for doc in docs], dtype=float)
+    color = _grade_indices(docs, "Color", COLOR_ORDERING)
+    clarity = _grade_indices(docs, "Clarity", CLARITY_ORDERING)
+    quality = np.column_stack([
+        _grade_indices(docs, field, QUALITY_ORDERING) for field in ["Cut", "Polish", "Symmetry"]
+    ])
+    # Missing quality grades count as mid-scale rather than best or worst
+    quality = np.where(np.isnan(quality), (len(QUALITY_ORDERING) - 1) / 2, quality)
+    quality_penalty = quality.mean(axis=1) / (len(QUALITY_ORDERING) - 1)
+
+    penalty = np.zeros(n)
+    target_carat = _target_carat(constraints)
+    if target_carat:
+        penalty += 2.0 * np.abs(carat - target_carat) / target_carat
+    target_price = _target_price(constraints)
+    if target_price:
+        penalty += 1.5 * np.abs(price - target_price) / target_price
+    penalty += _grade_distance(color, COLOR_ORDERING, constraints, "Color", "ColorRange")
+    penalty += _grade_distance(clarity, CLARITY_ORDERING, constraints, "Clarity", "ClarityRange")
+    penalty += 0.5 * quality_penalty
+
+    # Keep Solr's own sort (price distance, etc.) as a small tie-breaker
+    penalty += 0.1 * np.arange(n) / n
+    # Missing numeric fields push a stone to the back
+    penalty = np.where(np.isnan(penalty), np.nanmax(penalty, initial=0) + 1, penalty)
+    relevance = 1 - penalty / (penalty.max() or 1)
+
+    # Explicit ordering requests from the query, in the same precedence as the Solr sort
+    order_keys = []
+    if any(keyword in user_query.lower() for keyword in ["maximum carat", "max carat", "largest diamond", "biggest diamond"]):
+        order_keys.append(-carat)
+    if "PriceOrder" in constraints:
+        order_keys.append(price if constraints["PriceOrder"] == "asc" else -price)
+    if order_keys:
+        # np.lexsort treats the last key as primary; missing values sort last
+        keys = [-relevance] + [np.nan_to_num(key, nan=np.inf) for key in reversed(order_keys)]
+        return [docs[i] for i in np.lexsort(keys)[:k]]
+
+    # Feature space for diversity: log price, carat, color, clarity, quality
+    features = np.column_stack([
+        np.log1p(np.nan_to_num(price)), np.nan_to_num(carat),
+        np.nan_to_num(color, nan=len(COLOR_ORDERING)), np.nan_to_num(clarity, nan=len(CLARITY_ORDERING)),
+        quality_penalty
+    ])
+    spread = features.std(axis=0)
+    features = (features - features.mean(axis=0)) / np.where(spread > 0, spread, 1)
+    distances = np.linalg.norm(features[:, None, :] - features[None, :, :], axis=2)
+    similarity = np.exp(-distances)
+
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(min(k, n) - 1):
+        mmr = (1 - diversity) * relevance - diversity * max_similarity
+        mmr[selected] = -np.inf
+        choice = int(np.argmax(mmr))
+        selected.append(choice)
+        max_similarity = np.maximum(max_similarity, similarity[choice])
+    return [docs[i] for i in selected]
+
 # ------------------- Groq Integration -------------------
 def generate_groq_response(user_query, relevant_data, client):
     prompt = f"""
@@ -613,13 +735,26 @@ Below are some diamond details:
 
 Make sure the JSON is valid and can be parsed by JavaScript's JSON.parse() function.
 """
-    chat_completion = client.chat.completions.create(
-        messages=[{"role": "system", "content": prompt}],
-        model="llama-3.3-70b-specdec",
-        temperature=0.7,
-        max_tokens=2000
-    )
-    return chat_completion.choices[0].message.content
+    cache_key = make_cache_key("llama-3.3-70b-specdec", prompt)
+    cached_response = shared_cache.get("llm", cache_key)
+    if cached_response is not None:
+        annotate("llm_cache_hit", True)
+        return cached_response
+
+    estimated_tokens = estimate_tokens(prompt, 2000)
+    with stage("narrative"):
+        groq_scheduler.acquire("llama-3.3-70b-specdec", estimated_tokens, kind=NARRATIVE)
+        chat_completion = client.chat.completions.create(
+            messages=[{"role": "system", "content": prompt}],
+            model="llama-3.3-70b-specdec",
+            temperature=0.7,
+            max_tokens=2000
+        )
+    usage = getattr(chat_completion, "usage", None)
+    groq_scheduler.reconcile("llama-3.3-70b-specdec", estimated_tokens, getattr(usage, "total_tokens", None))
+    response = chat_completion.choices[0].message.content
+    shared_cache.set("llm", cache_key, response, LLM_CACHE_TTL)
+    return response
 
 # ------------------- Main Chatbot Logic -------------------
 def diamond_chatbot(user_query, solr_client, client):
@@ -638,9 +773,9 @@ def diamond_chatbot(user_query, solr_client, client):
     if not docs:
         return "No matching diamonds found. Please try a different query."
 
-    random.shuffle(docs)  # Randomize the order of the retrieved documents
-
-    top_5 = docs[:5]
+    # Score every candidate and keep five strong but varied picks
+    with stage("rerank"):
+        top_5 = rerank_candidates(docs, constraints, user_query, k=5)
     relevant_data_list = []
     for doc in top_5:
         diamond_info = {
@@ -0,0 +1,306 @@
+import os
+import json
+import sqlite3
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from cache import shared_cache
+
+# Load environment variables
+load_dotenv()
+
+# Requests and tokens per minute per model; override with GROQ_RATE_LIMITS='{"model": [rpm, tpm]}'
+DEFAULT_RATE_LIMITS = {
+    "llama-3.3-70b-specdec": [30, 6000],
+    "whisper-large-v3-turbo": [20, None],
+}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("GROQ_RATE_LIMITS", "{}"))}
+FALLBACK_RATE_LIMIT = [30, None]
+
+MAX_QUEUE_PER_MODEL = int(os.getenv("GROQ_MAX_QUEUE", "64"))
+# Per-session admission counts are forgotten after this many seconds
+FAIRNESS_WINDOW = 60
+
+# ------------------- Priorities -------------------
+# Lower sorts first. Interactive traffic always goes ahead of batch (cache warming),
+# and within a class the chat narrative and transcription go ahead of expert analysis.
+INTERACTIVE = 0
+BATCH = 1
+NARRATIVE = 0
+TRANSCRIPTION = 0
+EXPERT_ANALYSIS = 1
+
+# Share of each bucket that batch traffic may not use, so interactive calls in any
+# worker on the host can still be served while another worker is warming the cache
+BATCH_RESERVE = float(os.getenv("GROQ_BATCH_RESERVE", "0.5"))
+
+# Longest a request may wait in the queue before it is rejected (seconds)
+QUEUE_TIMEOUTS = {
+    INTERACTIVE: float(os.getenv("GROQ_QUEUE_TIMEOUT", "10")),
+    BATCH: float(os.getenv("GROQ_BATCH_QUEUE_TIMEOUT", "120")),
+}
+
+_session = contextvars.ContextVar("groq_session", default="anonymous")
+_traffic_class = contextvars.ContextVar("groq_traffic_class", default=INTERACTIVE)
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a Groq call cannot be scheduled within its queue timeout.
+    """
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def set_session(session_id):
+    """
+    Tag Groq calls made by the current request with a session (used for fair sharing).
+    """
+    _session.set(session_id or "anonymous")
+
+
+@contextmanager
+def batch_traffic():
+    """
+    Mark Groq calls made inside this block as batch work (e.g. cache warming).
+    """
+    token = _traffic_class.set(BATCH)
+    try:
+        yield
+    finally:
+        _traffic_class.reset(token)
+
+
+def estimate_tokens(prompt, max_tokens):
+    """
+    Rough token estimate for TPM accounting: ~4 characters per token plus the completion budget.
+    """
+    return len(prompt) // 4 + max_tokens
+
+
+# ------------------- Token Buckets -------------------
+class SharedRateBuckets:
+    """
+    Request- and token-per-minute buckets for each model. Bucket levels live in the shared
+    cache database and are updated inside BEGIN IMMEDIATE transactions, so the configured
+    limits apply to the whole host rather than to each worker process. Falls back to
+    in-process levels when the shared cache is disabled or unavailable.
+    """
+
+    def __init__(self, rate_limits=RATE_LIMITS, store=shared_cache):
+        self.rate_limits = rate_limits
+        self.store = store
+        self._local = {}  # name -> (level, updated_at), used without the shared store
+        self._lock = threading.Lock()
+
+    def _capacities(self, model):
+        rpm, tpm = self.rate_limits.get(model, FALLBACK_RATE_LIMIT)
+        capacities = {f"{model}:requests": float(rpm)}
+        if tpm:
+            capacities[f"{model}:tokens"] = float(tpm)
+        return capacities
+
+    @staticmethod
+    def _refill(capacities, stored, now):
+        levels = {}
+        for name, capacity in capacities.items():
+            level, updated_at = stored.get(name, (capacity, now))
+            levels[name] = min(capacity, level + max(0.0, now - updated_at) * capacity / 60.0)
+        return levels
+
+    def _update(self, model, action):
+        """
+        Refill the model's buckets, apply action(levels, capacities) and persist the new levels.
+        """
+        capacities = self._capacities(model)
+        now = time.time()
+        if self.store.enabled:
+            try:
+                conn = self.store.connection()
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS groq_buckets ("
+                    " name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)"
+                )
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    names = list(capacities)
+                    rows = conn.execute(
+                        f"SELECT name, level, updated_at FROM groq_buckets WHERE name IN ({','.join('?' * len(names))})",
+                        names
+                    ).fetchall()
+                    levels = self._refill(capacities, {name: (level, updated_at) for name, level, updated_at in rows}, now)
+                    result = action(levels, capacities)
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO groq_buckets (name, level, updated_at) VALUES (?, ?, ?)",
+                        [(name, level, now) for name, level in levels.items()]
+                    )
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                return result
+            except sqlite3.Error as e:
+                print(f"Shared Groq bucket error, using local buckets: {e}")
+
+        with self._lock:
+            levels = self._refill(capacities, self._local, now)
+            result = action(levels, capacities)
+            for name, level in levels.items():
+                self._local[name] = (level, now)
+            return result
+
+    @staticmethod
+    def _needs(model, requests, tokens):
+        return {f"{model}:requests": requests, f"{model}:tokens": tokens}
+
+    @staticmethod
+    def _wait(levels, capacities, needs, reserve=0.0):
+        # Only the part of a bucket above reserve * capacity is available to this caller
+        wait = 0.0
+        for name, capacity in capacities.items():
+            floor = reserve * capacity
+            amount = min(needs.get(name, 0), capacity - floor)
+            if levels[name] - floor < amount:
+                wait = max(wait, (amount - levels[name] + floor) / (capacity / 60.0))
+        return wait
+
+    def wait_time(self, model, tokens=0, requests=1, reserve=0.0):
+        """
+        Seconds until `requests` calls using `tokens` tokens fit in the host-wide limits,
+        leaving `reserve` (a share of capacity) untouched.
+        """
+        needs = self._needs(model, requests, tokens)
+        return self._update(model, lambda levels, capacities: self._wait(levels, capacities, needs, reserve))
+
+    def try_take(self, model, tokens=0, reserve=0.0):
+        """
+        Take capacity for one call if it is available now without dipping into `reserve`.
+        Returns 0 on success, otherwise the seconds to wait before trying again.
+        """
+        needs = self._needs(model, 1, tokens)
+
+        def take(levels, capacities):
+            wait = self._wait(levels, capacities, needs, reserve)
+            if wait == 0:
+                for name, capacity in capacities.items():
+                    levels[name] -= min(needs[name], capacity)
+            return wait
+
+        return self._update(model, take)
+
+    def adjust_tokens(self, model, delta):
+        """
+        Charge (or refund, if negative) tokens once a call's real usage is known.
+        """
+        def adjust(levels, capacities):
+            name = f"{model}:tokens"
+            if name in levels:
+                levels[name] = min(capacities[name], levels[name] - delta)
+
+        self._update(model, adjust)
+
+
+# ------------------- Scheduler -------------------
+class GroqScheduler:
+    """
+    Admission control in front of every Groq call. Each model has host-wide request- and
+    token-per-minute buckets (shared by all workers) and, in each worker, a bounded priority
+    queue ordered by (traffic class, call kind, session share, arrival). Callers whose
+    estimated wait exceeds their timeout are rejected up front instead of hitting Groq's
+    rate limits.
+    """
+
+    def __init__(self, rate_limits=RATE_LIMITS, max_queue=MAX_QUEUE_PER_MODEL, store=shared_cache):
+        self.buckets = SharedRateBuckets(rate_limits, store)
+        self.max_queue = max_queue
+        self._queues = {}
+        self._served = {}
+        self._served_reset = time.monotonic()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def _queue(self, model):
+        return self._queues.setdefault(model, [])
+
+    def _session_share(self, session_id, now):
+        if now - self._served_reset > FAIRNESS_WINDOW:
+            self._served = {}
+            self._served_reset = now
+        return self._served.get(session_id, 0)
+
+    def acquire(self, model, tokens=0, kind=NARRATIVE, timeout=None):
+        traffic_class = _traffic_class.get()
+        session_id = _session.get()
+        timeout = QUEUE_TIMEOUTS[traffic_class] if timeout is None else timeout
+        # Batch calls leave a share of every bucket to interactive calls from all workers
+        reserve = BATCH_RESERVE if traffic_class == BATCH else 0.0
+
+        # Bucket transactions touch SQLite, so they run outside self._cond
+        with self._cond:
+            now = time.monotonic()
+            queue = self._queue(model)
+            if len(queue) >= self.max_queue:
+                raise AdmissionRejected(f"Groq queue for {model} is full", retry_after=timeout)
+
+            key = (traffic_class, kind, self._session_share(session_id, now), next(self._sequence))
+            ahead = [entry for entry in queue if entry[0] < key]
+            entry = (key, tokens)
+            heapq.heappush(queue, entry)
+        deadline = now + timeout
+
+        # Early rejection: estimate the wait behind everything already queued ahead of us
+        ahead_tokens = sum(queued[1] for queued in ahead) + tokens
+        estimated_wait = self.buckets.wait_time(model, ahead_tokens, requests=len(ahead) + 1, reserve=reserve)
+        if estimated_wait > timeout:
+            self._leave(queue, entry)
+            raise AdmissionRejected(
+                f"Estimated Groq wait {estimated_wait:.1f}s exceeds {timeout:.1f}s", retry_after=estimated_wait
+            )
+
+        while True:
+            with self._cond:
+                while queue[0] is not entry:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._leave(queue, entry)
+                        raise AdmissionRejected(f"Timed out waiting for Groq capacity on {model}")
+                    self._cond.wait(remaining)
+
+            # Other workers draw from the same buckets, so re-check after every wait
+            wait = self.buckets.try_take(model, tokens, reserve=reserve)
+            with self._cond:
+                if wait == 0:
+                    self._leave(queue, entry)
+                    self._served[session_id] = self._served.get(session_id, 0) + 1
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._leave(queue, entry)
+                    raise AdmissionRejected(f"Timed out waiting for Groq capacity on {model}")
+                self._cond.wait(min(wait, remaining))
+
+    def _leave(self, queue, entry):
+        # self._cond wraps an RLock, so this is safe with or without it held
+        with self._cond:
+            queue.remove(entry)
+            heapq.heapify(queue)
+            self._cond.notify_all()
+
+    def reconcile(self, model, estimated_tokens, actual_tokens):
+        """
+        Correct the TPM bucket once the real usage of a completed call is known.
+        """
+        if actual_tokens is None:
+            return
+        self.buckets.adjust_tokens(model, actual_tokens - estimated_tokens)
+        with self._cond:
+            self._cond.notify_all()
+
+
+groq_scheduler = GroqScheduler()
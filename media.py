@@ -0,0 +1,80 @@
+import os
+import hashlib
+from flask import Blueprint, request, send_file, send_from_directory, abort
+from werkzeug.security import safe_join
+from dotenv import load_dotenv
+
+# Pillow is only needed for thumbnails; without it originals are always served
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Load environment variables
+load_dotenv()
+
+MEDIA_ROOT = os.path.abspath(os.getenv("MEDIA_ROOT", "media"))
+MEDIA_CACHE_DIR = os.path.abspath(os.getenv("MEDIA_CACHE_DIR", os.path.join(MEDIA_ROOT, ".thumbs")))
+# Media URLs are not versioned, so keep this short: once it expires, clients revalidate
+# with the ETag and pick up replaced photos and videos (a 304 costs no body)
+MEDIA_MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", str(24 * 3600)))
+
+# Only a few fixed widths are allowed so the derivative cache stays bounded
+THUMBNAIL_WIDTHS = (160, 320, 640, 1024)
+THUMBNAIL_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+
+media_bp = Blueprint("media", __name__)
+
+
+# ------------------- Thumbnail Derivatives -------------------
+def get_thumbnail(source_path, width):
+    """
+    Return the path of a cached JPEG thumbnail for source_path, creating it if needed.
+    The cache name includes the source mtime and size, so replaced files get fresh thumbnails.
+    """
+    stat = os.stat(source_path)
+    digest = hashlib.sha1(f"{source_path}:{stat.st_mtime_ns}:{stat.st_size}:{width}".encode("utf-8")).hexdigest()
+    thumb_path = os.path.join(MEDIA_CACHE_DIR, digest[:2], f"{digest}.jpg")
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    with Image.open(source_path) as img:
+        img.thumbnail((width, width * 4))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        # Write to a temp name and rename so concurrent workers never serve a partial file
+        tmp_path = f"{thumb_path}.{os.getpid()}.tmp"
+        img.save(tmp_path, "JPEG", quality=82, optimize=True, progressive=True)
+    os.replace(tmp_path, thumb_path)
+    return thumb_path
+
+
+# ------------------- Media Route -------------------
+@media_bp.route('/media/<path:filename>')
+def serve_media(filename):
+    """
+    Serve local catalog images, videos and PDFs with Range support, strong ETags and
+    MEDIA_MAX_AGE cache headers. Pass ?w=<width> on images to get a cached thumbnail.
+    """
+    source_path = safe_join(MEDIA_ROOT, filename)
+    if source_path is None or not os.path.isfile(source_path):
+        abort(404)
+
+    width = request.args.get("w", type=int)
+    if width and Image is not None and source_path.lower().endswith(THUMBNAIL_EXTENSIONS):
+        # Round up to the nearest allowed width
+        width = next((w for w in THUMBNAIL_WIDTHS if w >= width), THUMBNAIL_WIDTHS[-1])
+        try:
+            thumb_path = get_thumbnail(source_path, width)
+            response = send_file(thumb_path, mimetype="image/jpeg", conditional=True, max_age=MEDIA_MAX_AGE)
+            response.cache_control.public = True
+            return response
+        except Exception as e:
+            print(f"Thumbnail error for {filename}: {e}")
+
+    # conditional=True handles If-None-Match and Range requests (206) for video seeking;
+    # the file is returned through wsgi.file_wrapper so servers can use sendfile.
+    response = send_from_directory(MEDIA_ROOT, filename, conditional=True, max_age=MEDIA_MAX_AGE)
+    response.cache_control.public = True
+    return response
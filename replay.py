@@ -0,0 +1,131 @@
+import io
+import json
+import time
+import pstats
+import argparse
+import cProfile
+import statistics
+import pysolr
+from chatbot import extract_constraints_from_query, direct_solr_search, create_solr_client
+from cache import shared_cache
+
+# "search" is all of direct_solr_search, which re-runs constraint extraction before querying Solr
+STAGES = ["extract", "search", "total"]
+
+
+# ------------------- Capture Loading -------------------
+def load_capture(paths, limit=None):
+    """
+    Read captured /chat records in file order (deterministic replay).
+    """
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if record.get("query"):
+                    records.append(record)
+                if limit and len(records) >= limit:
+                    return records
+    return records
+
+
+# ------------------- Replay -------------------
+def replay(records, solr_client, top_k=100):
+    """
+    Feed every captured query through extract_constraints_from_query and direct_solr_search.
+    Returns per-stage latencies in milliseconds.
+    """
+    timings = {name: [] for name in STAGES}
+    for record in records:
+        user_query = record["query"]
+        started = time.perf_counter()
+        extract_constraints_from_query(user_query)
+        extracted = time.perf_counter()
+        direct_solr_search(user_query, solr_client, top_k=top_k)
+        finished = time.perf_counter()
+
+        timings["extract"].append((extracted - started) * 1000)
+        timings["search"].append((finished - extracted) * 1000)
+        timings["total"].append((finished - started) * 1000)
+    return timings
+
+
+def summarize(timings):
+    summary = {}
+    for name, values in timings.items():
+        if not values:
+            continue
+        ordered = sorted(values)
+        summary[name] = {
+            "count": len(ordered),
+            "mean": statistics.fmean(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            "max": ordered[-1]
+        }
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'stage':<10}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'max':>10}")
+    for name, stats in summary.items():
+        print(f"{name:<10}{stats['count']:>8}{stats['mean']:>10.3f}{stats['p50']:>10.3f}"
+              f"{stats['p95']:>10.3f}{stats['max']:>10.3f}")
+        if baseline and name in baseline:
+            base = baseline[name]
+            deltas = []
+            for key in ["mean", "p50", "p95"]:
+                change = (stats[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+                deltas.append(f"{key} {change:+.1f}%")
+            print(f"{'':<10}vs baseline: {', '.join(deltas)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured /chat queries and profile the search pipeline.")
+    parser.add_argument("paths", nargs="+", help="Capture files (capture-*.jsonl)")
+    parser.add_argument("--solr-url", help="Solr core URL to replay against (defaults to SOLR_URL/SOLR_COLLECTION_NAME)")
+    parser.add_argument("--limit", type=int, help="Replay at most this many queries")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and print a hotspot table")
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key for the hotspot table")
+    parser.add_argument("--top", type=int, default=25, help="Rows in the hotspot table")
+    parser.add_argument("--save", help="Write the latency summary to this JSON file")
+    parser.add_argument("--compare", help="Baseline summary JSON (from --save on another code version)")
+    parser.add_argument("--use-cache", action="store_true", help="Allow hits from the shared cache")
+    args = parser.parse_args()
+
+    if not args.use_cache:
+        shared_cache.enabled = False
+    solr_client = pysolr.Solr(args.solr_url, timeout=10) if args.solr_url else create_solr_client()
+    records = load_capture(args.paths, args.limit)
+    print(f"Replaying {len(records)} captured queries")
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    timings = replay(records, solr_client)
+    if profiler:
+        profiler.disable()
+
+    summary = summarize(timings)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    if profiler:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(args.sort).print_stats(args.top)
+        print(out.getvalue())
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import os
+import csv
+import json
+import time
+import uuid
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from chatbot import create_solr_client
+from cache import shared_cache
+from groq import Groq
+from warming import warm_cache, WARM_NARRATIVES
+
+# Load environment variables
+load_dotenv()
+
+DEFAULT_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+DEFAULT_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+# Soft commit window (ms) so new stones become searchable without a hard commit per batch
+DEFAULT_COMMIT_WITHIN = int(os.getenv("INGEST_COMMIT_WITHIN", "10000"))
+
+NUMERIC_FIELDS = ["Carat", "Price", "Width", "Height", "Length", "Depth"]
+
+
+# ------------------- Grade Normalization -------------------
+# Map feed spellings onto the codes extract_constraints_from_query emits
+QUALITY_CODES = {
+    "ex": "EX", "excellent": "EX", "exc": "EX",
+    "id": "ID", "ideal": "ID",
+    "vg": "VG", "very good": "VG", "verygood": "VG",
+    "gd": "GD", "g": "GD", "good": "GD",
+    "f": "F", "fr": "F", "fair": "F",
+    "p": "P", "pr": "P", "poor": "P"
+}
+FLO_CODES = {
+    "non": "NON", "none": "NON", "n": "NON", "no": "NON",
+    "fnt": "FNT", "faint": "FNT", "f": "FNT",
+    "med": "MED", "medium": "MED", "m": "MED",
+    "stg": "STG", "strong": "STG", "s": "STG",
+    "vsl": "VSL", "very slight": "VSL",
+    "slt": "SLT", "slight": "SLT",
+    "vst": "VST", "very strong": "VST"
+}
+STYLE_CODES = {
+    "lab": "lab", "labgrown": "lab", "lab grown": "lab", "lab-grown": "lab", "lgd": "lab",
+    "natural": "natural", "nat": "natural", "mined": "natural"
+}
+
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def normalize_diamond(row):
+    """
+    Normalize one feed record into a diamond_core document. Returns None if the row has no id.
+    """
+    doc = {key: value for key, value in row.items() if _clean(value) is not None}
+    if "id" not in doc:
+        return None
+    doc["id"] = _clean(doc["id"])
+
+    for field in NUMERIC_FIELDS:
+        if field in doc:
+            try:
+                doc[field] = float(str(doc[field]).replace(",", "").replace("$", ""))
+            except ValueError:
+                del doc[field]
+
+    for field in ["Cut", "Polish", "Symmetry"]:
+        if field in doc:
+            grade = _clean(doc[field]).lower()
+            doc[field] = QUALITY_CODES.get(grade, grade.upper())
+
+    if "Flo" in doc:
+        flo = _clean(doc["Flo"]).lower()
+        doc["Flo"] = FLO_CODES.get(flo, flo.upper())
+
+    if "Style" in doc:
+        style = _clean(doc["Style"]).lower()
+        doc["Style"] = STYLE_CODES.get(style, style)
+
+    for field in ["Shape", "Color", "Clarity", "Lab"]:
+        if field in doc:
+            doc[field] = _clean(doc[field]).upper()
+
+    return doc
+
+
+# ------------------- Streaming Feed Readers -------------------
+def read_feed(path, feed_format=None):
+    """
+    Yield raw records one at a time from a CSV or JSONL feed.
+    """
+    feed_format = feed_format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+    with open(path, newline="", encoding="utf-8") as f:
+        if feed_format == "csv":
+            for row in csv.DictReader(f):
+                yield row
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def is_delete(row):
+    """
+    Delta feeds mark removed stones with op=delete (or _delete=true).
+    """
+    op = str(row.get("op") or row.get("_op") or "").lower()
+    return op == "delete" or str(row.get("_delete", "")).lower() in ["1", "true", "yes"]
+
+
+# ------------------- Ingestion Pipeline -------------------
+class IngestStats:
+    def __init__(self):
+        self.added = 0
+        self.deleted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._last_report = self.started
+
+    def record(self, added=0, deleted=0, failed=0):
+        with self._lock:
+            self.added += added
+            self.deleted += deleted
+            self.failed += failed
+            now = time.time()
+            if now - self._last_report >= 5:
+                self._last_report = now
+                print(self.summary())
+
+    def summary(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        done = self.added + self.deleted
+        return (f"{self.added} added, {self.deleted} deleted, {self.skipped} skipped, {self.failed} failed "
+                f"in {elapsed:.1f}s ({done / elapsed:.0f} docs/s)")
+
+
+class BatchTracker:
+    """
+    Bounds the number of in-flight batches and keeps feed order per stone: a batch is not
+    started while an earlier batch touching any of the same ids is still running.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._cond = threading.Condition()
+        self._batches = 0
+        self._ids = {}  # id -> number of in-flight batches containing it
+
+    def start(self, ids):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._batches < self.limit and not any(doc_id in self._ids for doc_id in ids)
+            )
+            self._batches += 1
+            for doc_id in ids:
+                self._ids[doc_id] = self._ids.get(doc_id, 0) + 1
+
+    def finish(self, ids):
+        with self._cond:
+            self._batches -= 1
+            for doc_id in ids:
+                self._ids[doc_id] -= 1
+                if not self._ids[doc_id]:
+                    del self._ids[doc_id]
+            self._cond.notify_all()
+
+
+def ingest(paths, solr_client, feed_format=None, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS,
+           commit_within=DEFAULT_COMMIT_WITHIN, full=False, delta=False, warm=True, client=None):
+    """
+    Stream feeds into Solr in batches from a pool of workers, then hard commit and invalidate caches.
+    At most 2 * workers batches are held in memory at any time.
+    Rows are batched in feed order (a batch holds only adds or only deletes), and batches that share
+    a stone id never run concurrently, so a delete followed by a relist (or the reverse) keeps its order.
+    With full=True, every document is tagged with a run id and stones missing from the feed are deleted.
+    With delta=True, rows are sent as atomic updates that only set the fields present in the row,
+    so a partial row (e.g. id,Price) leaves the stone's other fields untouched.
+    With warm=True, the most popular searches are prefetched once the load is committed
+    (including Groq narratives when a client is given and WARM_NARRATIVES=1).
+    """
+    stats = IngestStats()
+    run_id = uuid.uuid4().hex if full else None
+    tracker = BatchTracker(workers * 2)
+
+    def send_adds(docs, ids):
+        try:
+            if delta:
+                # Atomic "set" updates for every field present in this batch (id excluded)
+                field_updates = {key: "set" for doc in docs for key in doc if key != "id"}
+                solr_client.add(docs, fieldUpdates=field_updates, commit=False, commitWithin=commit_within)
+            else:
+                solr_client.add(docs, commit=False, commitWithin=commit_within)
+            stats.record(added=len(docs))
+        except Exception as e:
+            print(f"Solr add error ({len(docs)} docs): {e}")
+            stats.record(failed=len(docs))
+        finally:
+            tracker.finish(ids)
+
+    def send_deletes(ids):
+        try:
+            solr_client.delete(id=ids, commit=False)
+            stats.record(deleted=len(ids))
+        except Exception as e:
+            print(f"Solr delete error ({len(ids)} ids): {e}")
+            stats.record(failed=len(ids))
+        finally:
+            tracker.finish(ids)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch, batch_op = [], None
+
+        def flush():
+            if not batch:
+                return
+            if batch_op == "delete":
+                ids = list(batch)
+                tracker.start(ids)
+                pool.submit(send_deletes, ids)
+            else:
+                ids = [doc["id"] for doc in batch]
+                tracker.start(ids)
+                pool.submit(send_adds, list(batch), ids)
+            batch.clear()
+
+        for path in paths:
+            for row in read_feed(path, feed_format):
+                if is_delete(row):
+                    op, item = "delete", _clean(row.get("id"))
+                else:
+                    row = {k: v for k, v in row.items() if k not in ["op", "_op", "_delete"]}
+                    op, item = "add", normalize_diamond(row)
+                if not item:
+                    stats.skipped += 1
+                    continue
+                if op == "add" and run_id:
+                    item["ingest_run_s"] = run_id
+
+                # Switching between adds and deletes closes the current batch to keep feed order
+                if op != batch_op:
+                    flush()
+                    batch_op = op
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    flush()
+        flush()
+
+    if run_id and stats.failed:
+        print("Skipping removal of stale stones because some batches failed.")
+    elif run_id:
+        # Drop stones that were not present in this full feed
+        solr_client.delete(q=f"*:* -ingest_run_s:{run_id}", commit=False)
+
+    # One hard commit at the end instead of one per batch
+    solr_client.commit()
+    on_inventory_refresh(solr_client, warm=warm, client=client)
+    print(f"Ingestion complete: {stats.summary()}")
+    return stats
+
+
+def on_inventory_refresh(solr_client, warm=True, client=None):
+    """
+    Invalidate cached search results and narratives after the inventory changes,
+    then re-warm the most popular searches (and their narratives if a Groq client is given).
+    """
+    shared_cache.clear("solr")
+    shared_cache.clear("llm")
+    if warm:
+        warm_cache(solr_client, client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream CSV/JSONL diamond feeds into diamond_core.")
+    parser.add_argument("paths", nargs="+", help="Feed files (.csv, .jsonl)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Override feed format detection")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--commit-within", type=int, default=DEFAULT_COMMIT_WITHIN,
+                        help="Soft commit window in milliseconds")
+    parser.add_argument("--full", action="store_true",
+                        help="Full reindex: delete stones missing from the feed after loading")
+    parser.add_argument("--delta", action="store_true",
+                        help="Delta feed: update only the fields present in each row instead of replacing stones")
+    parser.add_argument("--no-warm", action="store_true",
+                        help="Skip warming popular searches after the load")
+    args = parser.parse_args()
+
+    # Narratives can only be re-warmed with a Groq client
+    client = Groq() if WARM_NARRATIVES and not args.no_warm else None
+    ingest(args.paths, create_solr_client(), feed_format=args.format, batch_size=args.batch_size,
+           workers=args.workers, commit_within=args.commit_within, full=args.full,
+           delta=args.delta, warm=not args.no_warm, client=client)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,100 @@ window.closeModal = closeModal;
 // Global variable to hold the last search query
 let lastQuery = "";
 
+// Messages older than this many are swapped out for fixed-height placeholders
+const MAX_LIVE_MESSAGES = 30;
+const recycledMessages = new Map();
+const supportsIntersectionObserver = "IntersectionObserver" in window;
+
+/**
+ * Load images marked with data-src once they come near the viewport.
+ */
+const lazyMediaObserver = supportsIntersectionObserver
+  ? new IntersectionObserver((entries, observer) => {
+      entries.forEach(entry => {
+        if (entry.isIntersecting) {
+          loadLazyMedia(entry.target);
+          observer.unobserve(entry.target);
+        }
+      });
+    }, { rootMargin: "200px 0px" })
+  : null;
+
+function loadLazyMedia(element) {
+  if (element.dataset.src) {
+    element.src = element.dataset.src;
+    delete element.dataset.src;
+  }
+}
+
+function observeLazyMedia(root) {
+  root.querySelectorAll("[data-src]").forEach(element => {
+    if (lazyMediaObserver) {
+      lazyMediaObserver.observe(element);
+    } else {
+      loadLazyMedia(element);
+    }
+  });
+}
+
+/**
+ * Restore recycled messages when the user scrolls back up to them.
+ */
+const messageRestoreObserver = supportsIntersectionObserver
+  ? new IntersectionObserver(entries => {
+      entries.forEach(entry => {
+        if (entry.isIntersecting) {
+          restoreMessage(entry.target);
+        }
+      });
+    }, { root: document.getElementById("chatMessages"), rootMargin: "300px 0px" })
+  : null;
+
+/**
+ * Detach the content of old, off-screen messages so long chats keep a small DOM
+ * and release their images. Placeholders keep the original height so scrolling is stable.
+ */
+function recycleOldMessages() {
+  if (!messageRestoreObserver) return;
+  const chatMessages = document.getElementById("chatMessages");
+  const messages = chatMessages.querySelectorAll(".message");
+  const cutoff = messages.length - MAX_LIVE_MESSAGES;
+  for (let i = 0; i < cutoff; i++) {
+    const msg = messages[i];
+    if (recycledMessages.has(msg)) continue;
+    msg.style.height = `${msg.offsetHeight}px`;
+    msg.querySelectorAll("img[src]").forEach(img => {
+      img.dataset.src = img.getAttribute("src");
+      img.removeAttribute("src");
+    });
+    const fragment = document.createDocumentFragment();
+    while (msg.firstChild) {
+      fragment.appendChild(msg.firstChild);
+    }
+    recycledMessages.set(msg, fragment);
+    msg.classList.add("recycled");
+    messageRestoreObserver.observe(msg);
+  }
+}
+
+function restoreMessage(msg) {
+  const fragment = recycledMessages.get(msg);
+  if (!fragment) return;
+  messageRestoreObserver.unobserve(msg);
+  recycledMessages.delete(msg);
+  msg.appendChild(fragment);
+  msg.classList.remove("recycled");
+  msg.style.height = "";
+  observeLazyMedia(msg);
+}
+
 /**
  * Close the diamond details modal
  */
 function closeModal() {
   document.getElementById("detailsModal").style.display = "none";
+  // Drop the media so a playing video stops and its memory is released
+  document.getElementById("modalDetails").innerHTML = "";
 }
 
 /**
@@ -98,6 +187,8 @@ function addMessage(message, isUser = false) {
   
   chatMessages.appendChild(msgDiv);
   chatMessages.scrollTop = chatMessages.scrollHeight;
+  recycleOldMessages();
+  return bubble;
 }
 
 /**
@@ -176,41 +267,63 @@ function handleDiamondData(responseText) {
   // 2) Update search results bar with how many we found
   updateSearchResultsBar(`Found ${diamondData.length} Diamond${diamondData.length !== 1 ? 's' : ''} for '${lastQuery}'`);
 
-  // 3) Build HTML for diamond cards
-  // Create cards based on screen size - fewer cards for mobile
-  const isMobile = window.innerWidth < 768;
-  let cardsHtml = `<div class="diamond-cards-in-chat">`;
-  
-  for (const diamond of diamondData) {
-    const priceFormatted = formatPrice(diamond.Price);
-    const diamondObj = JSON.stringify(diamond).replace(/"/g, "&quot;");
-    cardsHtml += `
-      <div class="diamond-card-in-chat">
-        <div class="diamond-header">
-          <div class="diamond-title">
-            <strong>${diamond.Carat}ct </strong> ${diamond.Shape}
-          </div>
-          <div class="diamond-price">${priceFormatted}</div>
-        </div>
-        <div class="diamond-specs">
-          <div>Clarity:<strong>${diamond.Clarity}</strong></div>
-          <div>Color:<strong>${diamond.Color}</strong></div>
-          <div>Cut:<strong>${diamond.Cut}</strong></div>
-          <div>Polish:<strong>${diamond.Polish}</strong></div> 
-          <div>Symmetry:<strong>${diamond.Symmetry}</strong></div>
-          <div>Style:<strong>${diamond.Style}</strong></div>
-        </div>
-        <button class="view-details-btn" onclick='openModalWithDetails(${diamondObj})'>
-          View Details
-        </button>
-      </div>
-    `;
+  // 3) Display an empty card grid in a bot message bubble, then fill it in
+  const bubble = addMessage(`<div class="diamond-cards-in-chat"></div>`, false);
+  renderCardsIncrementally(bubble.querySelector(".diamond-cards-in-chat"), diamondData);
+}
+
+/**
+ * Append one card per animation frame so the chat stays responsive while cards render.
+ */
+function renderCardsIncrementally(container, diamonds) {
+  const chatMessages = document.getElementById("chatMessages");
+  let index = 0;
+  function renderNext() {
+    if (index >= diamonds.length) return;
+    const card = createDiamondCard(diamonds[index++]);
+    container.appendChild(card);
+    observeLazyMedia(card);
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+    requestAnimationFrame(renderNext);
   }
-  cardsHtml += `</div>`;
+  requestAnimationFrame(renderNext);
+}
 
-  // 4) Display them in a bot message bubble
-  addMessage(cardsHtml, false);
+/**
+ * Build a single diamond card. Cards only get a thumbnail when the image is served
+ * locally (so a small ?w= version exists); it loads once the card is near the viewport.
+ */
+function createDiamondCard(diamond) {
+  const priceFormatted = formatPrice(diamond.Price);
+  const thumbUrl = thumbnailUrl(diamond.image, 320);
+  const card = document.createElement("div");
+  card.classList.add("diamond-card-in-chat");
+  card.innerHTML = `
+    ${thumbUrl ? `
+    <img data-src="${thumbUrl}" alt="${diamond.Carat} Carat ${diamond.Shape}"
+         class="diamond-thumb" loading="lazy" decoding="async" />` : ""}
+    <div class="diamond-header">
+      <div class="diamond-title">
+        <strong>${diamond.Carat}ct </strong> ${diamond.Shape}
+      </div>
+      <div class="diamond-price">${priceFormatted}</div>
+    </div>
+    <div class="diamond-specs">
+      <div>Clarity:<strong>${diamond.Clarity}</strong></div>
+      <div>Color:<strong>${diamond.Color}</strong></div>
+      <div>Cut:<strong>${diamond.Cut}</strong></div>
+      <div>Polish:<strong>${diamond.Polish}</strong></div> 
+      <div>Symmetry:<strong>${diamond.Symmetry}</strong></div>
+      <div>Style:<strong>${diamond.Style}</strong></div>
+    </div>
+    <button class="view-details-btn">
+      View Details
+    </button>
+  `;
+  card.querySelector(".view-details-btn").addEventListener("click", () => openModalWithDetails(diamond));
+  return card;
 }
+
 /**
  * Helper to format price nicely with commas, e.g. $4,795
  */
@@ -226,6 +339,27 @@ function formatPrice(value) {
   }
 }
 
+/**
+ * Map a catalog media reference to a URL. Relative paths are served by the
+ * local /media route; pass a width to request a cached thumbnail.
+ */
+function mediaUrl(path, width) {
+  if (!path || /^(https?:)?\/\//i.test(path) || path.startsWith("/")) {
+    return path;
+  }
+  const url = `/media/${path.split("/").map(encodeURIComponent).join("/")}`;
+  return width ? `${url}?w=${width}` : url;
+}
+
+/**
+ * Thumbnail URL for a relative catalog image, or null for remote/absolute images,
+ * which have no resized version and would download at full size.
+ */
+function thumbnailUrl(path, width) {
+  const url = mediaUrl(path, width);
+  return url && url.startsWith("/media/") ? url : null;
+}
+
 /**
  * Open a modal with diamond details (image, looping video, PDF).
  * IMPROVED: Modal layout for better content display
@@ -261,7 +395,7 @@ function openModalWithDetails(diamond) {
   if (diamond.pdf) {
     modalHtml += `
         <div class="certificate-container">
-          <a href="${diamond.pdf}" target="_blank" class="pdf-link">
+          <a href="${mediaUrl(diamond.pdf)}" target="_blank" rel="noopener" class="pdf-link">
             <i class="fas fa-file-pdf"></i> View Certificate
           </a>
         </div>
@@ -272,7 +406,7 @@ function openModalWithDetails(diamond) {
   if (diamond.image) {
     modalHtml += `
       <div class="diamond-image-container">
-        <img src="${diamond.image}" alt="${diamond.Carat} Carat ${diamond.Shape}" class="diamond-image" />
+        <img src="${mediaUrl(diamond.image, 640)}" alt="${diamond.Carat} Carat ${diamond.Shape}" class="diamond-image" loading="lazy" decoding="async" />
       </div>
     `;
   }
@@ -282,15 +416,14 @@ function openModalWithDetails(diamond) {
   // Right column for video
   modalHtml += `<div class="modal-video-column">`;
   
-  // Add video
+  // Add video as a poster; the player only loads when the user asks for it
   if (diamond.video) {
+    const poster = diamond.image ? `style="background-image: url('${mediaUrl(diamond.image, 640)}')"` : "";
     modalHtml += `
-      <div class="diamond-video-container">
-        <iframe 
-          src="${diamond.video}"
-          class="diamond-video"
-          allowfullscreen
-        ></iframe>
+      <div class="diamond-video-container video-poster" ${poster}>
+        <button class="play-video-btn" aria-label="Play video">
+          <i class="fas fa-play"></i>
+        </button>
       </div>
     `;
   }
@@ -309,6 +442,23 @@ function openModalWithDetails(diamond) {
   // Set the HTML and display the modal
   modalDetails.innerHTML = modalHtml;
   modal.style.display = "flex";
+
+  const playButton = modalDetails.querySelector(".play-video-btn");
+  if (playButton) {
+    playButton.addEventListener("click", () => {
+      const container = playButton.parentElement;
+      container.classList.remove("video-poster");
+      container.style.backgroundImage = "";
+      container.innerHTML = `
+        <iframe 
+          src="${mediaUrl(diamond.video)}"
+          class="diamond-video"
+          allow="autoplay"
+          allowfullscreen
+        ></iframe>
+      `;
+    });
+  }
 }
 
 /**
@@ -394,31 +544,53 @@ document.addEventListener('DOMContentLoaded', function() {
           });
   }
 
+  // Transcription and the chat answer come back from a single /voice-chat request
   function sendAudioForTranscription(audioBlob) {
       let formData = new FormData();
       formData.append("audio", audioBlob, "recording.webm");
 
-      fetch("/speech-to-text", {
+      updateSearchResultsBar("Listening to your request.....");
+      hideExpertRecommendation();
+
+      fetch("/voice-chat", {
           method: "POST",
           body: formData
       })
-      .then(response => {
-          if (!response.ok) {
-              throw new Error("Transcription service error.");
+      .then(response => response.json().then(data => ({ ok: response.ok, data })))
+      .then(({ ok, data }) => {
+          // Server errors (e.g. 503 when Groq is busy) may arrive before any transcript exists
+          if (!ok && data.error) {
+              updateSearchResultsBar("");
+              if (data.transcript) {
+                  lastQuery = data.transcript;
+                  addMessage(data.transcript, true);
+              }
+              addMessage(data.error, false);
+              return;
           }
-          return response.json();
-      })
-      .then(data => {
-          if (data.transcript) {
-              userInput.value = data.transcript;
-              sendButton.click();
-          } else {
+          if (!data.transcript) {
               console.error("Transcript not returned:", data);
+              updateSearchResultsBar("");
               alert("Could not transcribe your voice message. Please try again.");
+              return;
+          }
+          lastQuery = data.transcript;
+          addMessage(data.transcript, true);
+          if (!ok) {
+              updateSearchResultsBar("");
+              addMessage("Sorry, I encountered an error processing your request.", false);
+              return;
+          }
+          if (data.needs_style) {
+              localStorage.setItem("pendingQuery", data.transcript);
+              showStylePopup();
+              return;
           }
+          showChatResponse(data);
       })
       .catch(err => {
-          console.error("Error during transcription:", err);
+          console.error("Error during voice chat:", err);
+          updateSearchResultsBar("");
           alert("There was an error processing your voice input.");
       });
   }
@@ -456,15 +628,7 @@ function sendMessage() {
       showStylePopup();
       return;
     }
-    addMessage(data.response, false);
-    handleDiamondData(data.response);
-    
-    // Display expert recommendation if available
-    if (data.expert_recommendation) {
-      showExpertRecommendation(data.expert_recommendation);
-    } else {
-      hideExpertRecommendation();
-    }
+    showChatResponse(data);
   })
   .catch(err => {
     console.error("Error:", err);
@@ -473,6 +637,21 @@ function sendMessage() {
   });
 }
 
+/**
+ * Render a chat answer: the reply bubble, diamond cards and expert recommendation.
+ */
+function showChatResponse(data) {
+  addMessage(data.response, false);
+  handleDiamondData(data.response);
+  
+  // Display expert recommendation if available
+  if (data.expert_recommendation) {
+    showExpertRecommendation(data.expert_recommendation);
+  } else {
+    hideExpertRecommendation();
+  }
+}
+
 /**
  * Show the expert recommendation section with the provided content.
  */
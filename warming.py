@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+from dotenv import load_dotenv
+from cache import shared_cache
+from chatbot import direct_solr_search, diamond_chatbot
+from groq_scheduler import batch_traffic
+from capture import anonymize_query
+
+# Load environment variables
+load_dotenv()
+
+# Number of in-process signatures tracked before the smallest counter is recycled (Space-Saving)
+TRACKER_CAPACITY = int(os.getenv("POPULAR_TRACKER_CAPACITY", "256"))
+# Flush in-process counts to the shared store after this many recorded queries
+TRACKER_FLUSH_EVERY = int(os.getenv("POPULAR_TRACKER_FLUSH_EVERY", "50"))
+# Signatures kept in the shared store across all workers
+POPULAR_STORE_SIZE = int(os.getenv("POPULAR_STORE_SIZE", "5000"))
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "300"))
+WARM_NARRATIVES = os.getenv("WARM_NARRATIVES", "0") == "1"
+# Only one worker on the host warms at a time
+WARM_LOCK_TTL = 600
+
+
+# ------------------- Constraint Signatures -------------------
+def constraint_signature(constraints):
+    """
+    Canonical string for a constraints dict, so differently worded queries with the same
+    constraints ("1ct round lab" / "lab grown round 1 carat") count as one search.
+    """
+    return json.dumps(constraints, sort_keys=True, separators=(",", ":"))
+
+
+# ------------------- Popular Query Tracker -------------------
+class PopularQueries:
+    """
+    Approximate top-K counter using the Space-Saving algorithm. Each worker keeps a small
+    in-process table and periodically merges it into a shared SQLite table, so counts are
+    host-wide and survive restarts.
+    """
+
+    def __init__(self, capacity=TRACKER_CAPACITY, flush_every=TRACKER_FLUSH_EVERY, store=shared_cache):
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.store = store
+        self._counts = {}  # signature -> [count, representative query]
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _table(self):
+        conn = self.store.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS popular_queries ("
+            " signature TEXT PRIMARY KEY,"
+            " query TEXT NOT NULL,"
+            " count REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        return conn
+
+    def record(self, user_query, constraints):
+        if not constraints:
+            return
+        signature = constraint_signature(constraints)
+        # The representative query is stored for good, so strip personal details first
+        user_query = anonymize_query(user_query)
+        with self._lock:
+            if signature in self._counts:
+                self._counts[signature][0] += 1
+            elif len(self._counts) < self.capacity:
+                self._counts[signature] = [1, user_query]
+            else:
+                # Replace the smallest counter and inherit its count (Space-Saving overestimate)
+                smallest = min(self._counts, key=lambda s: self._counts[s][0])
+                count = self._counts.pop(smallest)[0]
+                self._counts[signature] = [count + 1, user_query]
+            self._pending += 1
+            should_flush = self._pending >= self.flush_every
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts, self._pending = self._counts, {}, 0
+        if not counts or not self.store.enabled:
+            return
+        try:
+            conn = self._table()
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO popular_queries (signature, query, count, updated_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(signature) DO UPDATE SET count = count + excluded.count,"
+                " query = excluded.query, updated_at = excluded.updated_at",
+                [(signature, query, count, now) for signature, (count, query) in counts.items()]
+            )
+            conn.execute(
+                "DELETE FROM popular_queries WHERE signature NOT IN"
+                " (SELECT signature FROM popular_queries ORDER BY count DESC LIMIT ?)",
+                (POPULAR_STORE_SIZE,)
+            )
+        except Exception as e:
+            print(f"Popular query flush error: {e}")
+
+    def top(self, n=WARM_TOP_N):
+        """
+        Return representative queries for the n hottest signatures, hottest first.
+        """
+        if not self.store.enabled:
+            return []
+        try:
+            rows = self._table().execute(
+                "SELECT query FROM popular_queries ORDER BY count DESC LIMIT ?", (n,)
+            ).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"Popular query read error: {e}")
+            return []
+
+
+popular_queries = PopularQueries()
+
+
+# ------------------- Cache Warming -------------------
+def warm_cache(solr_client, client=None, top_n=WARM_TOP_N, narratives=WARM_NARRATIVES):
+    """
+    Prefetch Solr results (and optionally Groq narratives) for the hottest signatures.
+    Returns the number of queries warmed.
+    """
+    if not shared_cache.add("warm", "lock", True, WARM_LOCK_TTL):
+        print("Cache warming already running in another worker.")
+        return 0
+
+    started = time.time()
+    warmed = 0
+    try:
+        # Narrative warming queues behind interactive Groq traffic
+        with batch_traffic():
+            for user_query in popular_queries.top(top_n):
+                try:
+                    if narratives and client is not None:
+                        diamond_chatbot(user_query, solr_client, client)
+                    else:
+                        direct_solr_search(user_query, solr_client, top_k=100)
+                    warmed += 1
+                except Exception as e:
+                    print(f"Cache warming error for '{user_query}': {e}")
+    finally:
+        shared_cache.clear("warm")
+    print(f"Warmed {warmed} popular queries in {time.time() - started:.1f}s")
+    return warmed
+
+
+def start_cache_warming(solr_client, client=None, top_n=WARM_TOP_N, narratives=WARM_NARRATIVES):
+    """
+    Run warm_cache on a background daemon thread so startup is not delayed.
+    """
+    thread = threading.Thread(
+        target=warm_cache, args=(solr_client, client, top_n, narratives), daemon=True
+    )
+    thread.start()
+    return thread